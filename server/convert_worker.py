@@ -0,0 +1,39 @@
+"""
+Funções executadas nos workers do pool de conversão (pdf2docx).
+
+Ficam fora de latex_server.py porque os workers são iniciados por
+forkserver: cada um importa só este módulo, sem o Flask, o cliente GCS
+nem a limpeza de diretórios que latex_server faz ao ser importado.
+"""
+
+import signal
+
+
+def warm_pdf2docx():
+    """Inicializador dos workers: importa pdf2docx uma única vez por processo."""
+    try:
+        import pdf2docx  # noqa: F401
+    except ImportError:
+        pass
+
+def _conversion_timeout(signum, frame):
+    raise TimeoutError('pdf2docx excedeu o tempo limite')
+
+def pdf2docx_convert(pdf_path, docx_path, timeout):
+    """
+    Converte com pdf2docx (Python puro, prende o GIL). O limite de tempo
+    é aplicado aqui dentro, com SIGALRM: a conversão travada é
+    interrompida sem derrubar o worker nem as conversões dos outros.
+    """
+    from pdf2docx import Converter
+    previous = signal.signal(signal.SIGALRM, _conversion_timeout)
+    signal.alarm(timeout)
+    try:
+        cv = Converter(pdf_path)
+        try:
+            cv.convert(docx_path, start=0, end=None)
+        finally:
+            cv.close()
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
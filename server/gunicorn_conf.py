@@ -0,0 +1,40 @@
+"""
+Configuração do Gunicorn para o servidor LaTeX (produção).
+
+Uso:
+  gunicorn -c gunicorn_conf.py latex_server:app
+
+Workers gthread: subprocess.run libera o GIL enquanto o pdflatex roda, então
+threads escalam bem para compilações simultâneas. O padrão é um único
+processo porque o cache de projetos da compilação delta (project_cache) vive
+na memória do processo; aumente WEB_CONCURRENCY só se isso não importar.
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+threads = int(os.environ.get('GUNICORN_THREADS', str(multiprocessing.cpu_count() * 4)))
+
+# Uma compilação pode levar COMPILE_TIMEOUT; dá folga para o envio do PDF
+timeout = int(os.environ.get('COMPILE_TIMEOUT', '300')) + 60
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    """Aquece o motor LaTeX uma vez, antes de subir os workers."""
+    from latex_server import warmup_latex
+    warmup_latex()
+
+
+def post_worker_init(worker):
+    """Consultas feitas uma vez por processo saem da primeira requisição do worker."""
+    from latex_server import PRECOMPILE_PREAMBLE, mylatexformat_available
+    if PRECOMPILE_PREAMBLE:
+        mylatexformat_available()
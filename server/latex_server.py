@@ -4,6 +4,7 @@ Servidor LaTeX para Cloud (Cloud Run/AWS ECS) com conversão para Word
 
 Endpoints:
   POST /compile      — Compila arquivos .tex enviados como JSON
+  GET  /compile/<id> — Resultado de uma compilação assíncrona ("async": true)
   POST /compile-zip  — Compila projeto enviado como ZIP
   POST /compile-delta — Compila apenas mudanças (delta)
   POST /convert/word — Converte PDF para DOCX usando LibreOffice/pandoc
@@ -13,23 +14,38 @@ Endpoints:
 Deploy:
   - Google Cloud Run: gcloud run deploy --source .
   - AWS ECS: Use o Dockerfile com Fargate
+  - Produção: gunicorn -c gunicorn_conf.py latex_server:app
 """
 
 import os
 import sys
-import io
 import shutil
 import tempfile
+import tarfile
 import zipfile
 import subprocess
 import traceback
 import json
-from pathlib import Path
-from functools import wraps
+import re
+import hashlib
+import mmap
+import zlib
+import time
+import signal
+import uuid
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, wraps
 
-from flask import Flask, request, send_file, jsonify, render_template_string
+from flask import Flask, Response, request, send_file, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 
+import convert_worker
+
 # ═══════════════════════════════════════════════════════════════════
 #  Configuration (Cloud-Optimized)
 # ═══════════════════════════════════════════════════════════════════
@@ -37,10 +53,70 @@ from flask_cors import CORS
 SUPPORTED_ENGINES = ['pdflatex', 'xelatex', 'lualatex']
 DEFAULT_ENGINE = os.environ.get('LATEX_ENGINE', 'pdflatex')
 BIBTEX_CMD = 'bibtex'
+LATEXMK_CMD = 'latexmk'
+LATEXMK_ENGINE_FLAGS = {'pdflatex': '-pdf', 'xelatex': '-xelatex', 'lualatex': '-lualatex'}
+COMPILE_LOG_NAME = '.compile.log'  # Saída das passadas, gravada no diretório de trabalho
+BIB_SIGNATURE_NAME = '.bibsig'  # Assinatura (.bib + citações) do último BibTeX bem-sucedido
+PREAMBLE_FMT_NAME = 'olc-preamble'  # Formato com o preâmbulo pré-compilado (projetos persistentes)
+# Opcional: o .fmt só é validado por "gerou PDF", e há preâmbulos que o despejo altera
+PRECOMPILE_PREAMBLE = os.environ.get('PRECOMPILE_PREAMBLE', 'false').lower() == 'true'
+LOG_TAIL_SIZE = 5000  # Bytes do log devolvidos ao cliente
+MAX_LOG_ERRORS = 100  # Linhas de erro extraídas do log para a resposta
+RERUN_SCAN_SIZE = 16384  # Bytes finais do .log onde o aviso de rerun aparece
+MAIN_FILE_SCAN_SIZE = 4096  # Bytes iniciais lidos ao procurar \documentclass
+MAIN_FILE_MAX_SIZE = 4 * 1024 * 1024  # .tex maiores que isso não são candidatos a principal
+GZIP_MIN_SIZE = 64 * 1024  # PDFs menores que isso não compensam compressão
+GZIP_LEVEL = 1  # Nível rápido: os streams do PDF já são comprimidos
+ZSTD_LEVEL = 3  # Comprime mais que gzip -1 e ainda a centenas de MB/s
+STREAM_CHUNK_SIZE = 256 * 1024
+GCS_CHUNK_SIZE = 8 * 1024 * 1024  # Upload resumable em blocos de 8 MB (padrão da lib: 256 KB)
 COMPILE_TIMEOUT = int(os.environ.get('COMPILE_TIMEOUT', '300'))
 PORT = int(os.environ.get('PORT', '8080'))
 AUTH_TOKEN = os.environ.get('AUTH_TOKEN')  # Obrigatório em produção!
 MAX_REQUEST_SIZE = int(os.environ.get('MAX_REQUEST_SIZE', '50'))  # MB
+MAX_EXTRACTED_SIZE = int(os.environ.get('MAX_EXTRACTED_SIZE', '500'))  # MB descompactados (zip bomb)
+CACHE_DIR = os.environ.get('CACHE_DIR')  # Projetos persistentes (padrão abaixo)
+TMPFS_MIN_SIZE = 512 * 1024 * 1024  # O /dev/shm padrão do Docker (64 MB) é pequeno demais
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_MB', '512')) * 1024 * 1024
+PDF_CACHE_MAX_ENTRIES = int(os.environ.get('PDF_CACHE_MAX_ENTRIES', '256'))
+PROJECT_CACHE_MAX = int(os.environ.get('PROJECT_CACHE_MAX', '64'))  # Projetos persistentes mantidos
+PROJECT_CACHE_TTL = int(os.environ.get('PROJECT_CACHE_TTL', '1800'))  # Segundos sem uso até expirar
+CORS_ORIGINS = [o.strip() for o in os.environ.get('CORS_ORIGINS', '*').split(',') if o.strip()]
+CONVERT_WORKERS = int(os.environ.get('CONVERT_WORKERS', str(os.cpu_count() or 1)))
+CONVERT_QUEUE_GRACE = int(os.environ.get('CONVERT_QUEUE_GRACE', '60'))  # Segundos de espera na fila do pool
+COMPILE_JOB_WORKERS = int(os.environ.get('COMPILE_JOB_WORKERS', str(os.cpu_count() or 1)))
+COMPILE_JOB_TTL = 600  # Segundos que um resultado não buscado fica guardado
+WRITE_WORKERS = 8  # Threads que gravam os arquivos do projeto em paralelo
+PARALLEL_WRITE_MIN_FILES = 16  # Abaixo disso o custo das threads não compensa
+LIBREOFFICE_PROFILE = 'file:///tmp/olc-libreoffice-profile'  # Perfil reaproveitado entre conversões
+
+# Executáveis resolvidos uma vez: o PATH do container não muda em runtime
+TOOL_PATHS = {tool: shutil.which(tool)
+              for tool in SUPPORTED_ENGINES + [BIBTEX_CMD, LATEXMK_CMD, 'kpsewhich',
+                                               'libreoffice', 'pandoc']}
+
+# Ambiente dos processos LaTeX, montado uma vez em vez de copiar os.environ por passada
+COMPILE_ENV = {
+    **os.environ,
+    'MIKTEX_ENABLEINSTALLER': 't',
+    # Fora de /tmp no container (tmpfs esconderia o cache gerado no build)
+    'TEXMFVAR': os.environ.get('TEXMFVAR', '/tmp/texmf-var'),
+    'TEXMFCACHE': os.environ.get('TEXMFCACHE', os.environ.get('TEXMFVAR', '/tmp/texmf-var')),
+    'TMPDIR': '/tmp',  # Arquivos temporários das ferramentas TeX também em RAM
+}
+
+def _default_cache_dir():
+    """Prefere /dev/shm (tmpfs, em RAM) quando é gravável e tem espaço razoável."""
+    shm = '/dev/shm'
+    try:
+        if os.access(shm, os.W_OK) and shutil.disk_usage(shm).total >= TMPFS_MIN_SIZE:
+            return os.path.join(shm, 'latex-cache')
+    except OSError:
+        pass
+    return '/tmp/latex-cache'
+
+if not CACHE_DIR:
+    CACHE_DIR = _default_cache_dir()
 
 # Cloud storage para cache (opcional)
 USE_CLOUD_STORAGE = os.environ.get('USE_CLOUD_STORAGE', 'false').lower() == 'true'
@@ -54,12 +130,43 @@ if USE_CLOUD_STORAGE:
         USE_CLOUD_STORAGE = False
         print("[Cloud] google-cloud-storage não instalado, usando disco local")
 
+# Projetos em .tar.zst (opcional): descompressão em streaming bem mais rápida que ZIP
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Hash não criptográfico rápido (opcional) para nomes de diretório/chaves de cache
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# JSON nativo (opcional): decodifica o corpo de /compile e codifica as respostas
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify/request.get_json via orjson, mantendo a interface do Flask."""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+if orjson:
+    app.json = OrjsonProvider(app)
 CORS(app, resources={
     r"/*": {
-        "origins": "*",  # Em produção, restrinja para seus domínios
+        "origins": CORS_ORIGINS,  # Em produção, restrinja para seus domínios
         "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Authorization", "Content-Type"]
+        "allow_headers": ["Authorization", "Content-Type"],
+        "expose_headers": ["X-Cache", "X-Compile-Time-Ms"],
+        "max_age": 86400,  # Navegador reaproveita o preflight por 24h
     }
 })
 
@@ -67,7 +174,17 @@ CORS(app, resources={
 app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_SIZE * 1024 * 1024
 
 # Cache para projetos (para compilação delta)
-project_cache = {}  # projectId -> {files, timestamp}
+# Em ordem de uso (LRU); limitado por PROJECT_CACHE_MAX/PROJECT_CACHE_TTL
+project_cache = OrderedDict()  # projectId -> {directory, main_file, timestamp}
+project_cache_lock = threading.Lock()
+
+# Um projeto persistente é sincronizado e compilado por uma requisição de cada vez
+# (locks em faixas: memória fixa, sem ciclo de vida por projeto)
+PROJECT_LOCK_STRIPES = 64
+_project_locks = [threading.Lock() for _ in range(PROJECT_LOCK_STRIPES)]
+
+def project_lock(project_id):
+    return _project_locks[zlib.crc32(project_id.encode('utf-8')) % PROJECT_LOCK_STRIPES]
 
 # ═══════════════════════════════════════════════════════════════════
 #  Cloud Storage Helpers
@@ -79,8 +196,8 @@ def upload_to_gcs(local_path, destination_blob_name):
         return None
     try:
         bucket = storage_client.bucket(GCS_BUCKET)
-        blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(local_path)
+        blob = bucket.blob(destination_blob_name, chunk_size=GCS_CHUNK_SIZE)
+        blob.upload_from_filename(local_path, content_type='application/pdf', timeout=60)
         return blob.public_url
     except Exception as e:
         print(f"[GCS] Erro no upload: {e}")
@@ -142,48 +259,787 @@ def check_origin():
 
 def detect_available_engines():
     """Detecta motores LaTeX disponíveis."""
-    available = []
-    for eng in SUPPORTED_ENGINES:
-        if shutil.which(eng):
-            available.append(eng)
-    return available
+    return [eng for eng in SUPPORTED_ENGINES if TOOL_PATHS.get(eng)]
+
+def iter_tex_files(directory):
+    """Percorre a árvore com os.scandir (em largura) e gera caminhos .tex relativos."""
+    pending = ['']
+    while pending:
+        rel_dir = pending.pop(0)
+        try:
+            with os.scandir(os.path.join(directory, rel_dir)) as entries:
+                subdirs = []
+                for entry in entries:
+                    rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(rel_path)
+                    elif entry.name.lower().endswith('.tex') and entry.is_file():
+                        yield rel_path
+                pending.extend(subdirs)
+        except OSError:
+            continue
 
 def find_main_file(directory):
     """Encontra arquivo .tex principal."""
-    tex_files = list(Path(directory).rglob('*.tex'))
+    # Prioridade: main.tex na raiz (sem varrer o resto da árvore)
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.lower() == 'main.tex' and entry.is_file():
+                    return entry.name
+    except OSError:
+        return None
     
+    tex_files = list(iter_tex_files(directory))
     if not tex_files:
         return None
     
-    # Prioridade: main.tex na raiz
-    for f in tex_files:
-        if f.name.lower() == 'main.tex' and f.parent == Path(directory):
-            return str(f.relative_to(directory))
-    
     # Qualquer main.tex
-    for f in tex_files:
-        if f.name.lower() == 'main.tex':
-            return str(f.relative_to(directory))
+    for rel_path in tex_files:
+        if os.path.basename(rel_path).lower() == 'main.tex':
+            return rel_path
+    
+    # Arquivo com \documentclass (quase sempre no início do arquivo)
+    for rel_path in tex_files:
+        try:
+            with open(os.path.join(directory, rel_path), 'rb') as f:
+                head = f.read(MAIN_FILE_SCAN_SIZE)
+        except OSError:
+            continue
+        if b'\\documentclass' in head:
+            return rel_path
     
-    # Arquivo com \documentclass
-    for f in tex_files:
+    # Cabeçalhos longos (licença, comentários): varre o restante via mmap, sem decodificar
+    for rel_path in tex_files:
         try:
-            content = f.read_text(encoding='utf-8', errors='ignore')
-            if '\\documentclass' in content:
-                return str(f.relative_to(directory))
-        except Exception:
+            with open(os.path.join(directory, rel_path), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size <= MAIN_FILE_SCAN_SIZE or size > MAIN_FILE_MAX_SIZE:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if mm.find(b'\\documentclass', MAIN_FILE_SCAN_SIZE - 16) != -1:
+                        return rel_path
+        except OSError:
             continue
     
     # Fallback: primeiro .tex
-    return str(tex_files[0].relative_to(directory))
+    return tex_files[0]
+
+def get_project_cache_dir(project_id):
+    """Diretório persistente (por projectId) usado na compilação incremental."""
+    # Sempre blake2b (stdlib): o nome não pode depender de o xxhash estar instalado
+    safe_id = hashlib.blake2b(project_id.encode('utf-8'), digest_size=8).hexdigest()
+    project_dir = os.path.join(CACHE_DIR, 'projects', safe_id)
+    os.makedirs(project_dir, exist_ok=True)
+    return project_dir
+
+def copy_file_fast(src, dst):
+    """
+    Copia no kernel com copy_file_range (reflink em btrfs/xfs), sem passar
+    os dados pelo Python; cai para shutil.copyfile se não houver suporte.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            if remaining <= 0:
+                return
+        except (AttributeError, OSError):
+            pass
+    shutil.copyfile(src, dst)
+
+def write_file_bytes(path, data):
+    """Grava bytes com os.open/os.write, sem a pilha de codec/buffer de open()."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+# Compartilhado entre requisições; os.write libera o GIL, então as gravações se sobrepõem
+_write_pool = ThreadPoolExecutor(max_workers=WRITE_WORKERS, thread_name_prefix='olc-write')
+
+def write_project_files(directory, files):
+    """
+    Grava arquivos (str ou bytes) criando cada diretório pai uma única vez.
+    Projetos com muitos arquivos são gravados em paralelo.
+    """
+    parents = {os.path.dirname(os.path.join(directory, name)) for name in files}
+    for parent in parents:
+        os.makedirs(parent, exist_ok=True)
+    
+    def write_one(item):
+        name, content = item
+        data = content.encode('utf-8') if isinstance(content, str) else content
+        write_file_bytes(os.path.join(directory, name), data)
+    
+    if len(files) < PARALLEL_WRITE_MIN_FILES:
+        for item in files.items():
+            write_one(item)
+    else:
+        # list() propaga a primeira exceção de gravação para o chamador
+        list(_write_pool.map(write_one, files.items()))
+
+def sync_project_files(directory, files):
+    """
+    Sincroniza os arquivos recebidos com o diretório do projeto, reescrevendo
+    apenas os que mudaram (hashes em .hashes.json). Arquivos inalterados mantêm
+    o mtime, então o LaTeX reaproveita .aux/.toc da compilação anterior.
+    """
+    hashes = read_project_hashes(directory)
+    new_hashes = {}
+    changed = {}
+    for filename, content in files.items():
+        data = content.encode('utf-8')
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        new_hashes[filename] = digest
+        if hashes.get(filename) == digest and os.path.exists(os.path.join(directory, filename)):
+            continue
+        changed[filename] = data
+    write_project_files(directory, changed)
+    finish_project_sync(directory, hashes, new_hashes)
+    print(f'[Cache] {len(changed)}/{len(files)} arquivo(s) reescrito(s)')
+
+def sync_project_tree(source_dir, directory):
+    """
+    Mesma sincronização de sync_project_files, mas a partir de um projeto já
+    extraído em disco (/compile-zip). Arquivos alterados são movidos de source_dir.
+    """
+    hashes = read_project_hashes(directory)
+    new_hashes = {}
+    changed = 0
+    for root, _dirs, filenames in os.walk(source_dir):
+        for filename in filenames:
+            src = os.path.join(root, filename)
+            name = os.path.relpath(src, source_dir)
+            digest = file_digest(src)
+            new_hashes[name] = digest
+            target = os.path.join(directory, name)
+            if hashes.get(name) == digest and os.path.exists(target):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(src, target)
+            changed += 1
+    finish_project_sync(directory, hashes, new_hashes)
+    print(f'[Cache] {changed}/{len(new_hashes)} arquivo(s) reescrito(s)')
+
+def file_digest(path):
+    """Hash do conteúdo do arquivo, no mesmo formato de .hashes.json."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def read_project_hashes(directory):
+    """Hashes dos arquivos-fonte gravados na última sincronização do projeto."""
+    try:
+        with open(os.path.join(directory, '.hashes.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def finish_project_sync(directory, hashes, new_hashes):
+    """Remove os arquivos que saíram do projeto e grava os novos hashes."""
+    for filename in hashes.keys() - new_hashes.keys():
+        filepath = os.path.join(directory, filename)
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+    
+    with open(os.path.join(directory, '.hashes.json'), 'w', encoding='utf-8') as f:
+        json.dump(new_hashes, f)
+
+def record_delta_hashes(directory, written, deleted):
+    """
+    Atualiza .hashes.json com o que um delta gravou/apagou: a próxima sincronização
+    completa compara com o disco real (e remove arquivos que o delta adicionou).
+    """
+    hashes = read_project_hashes(directory)
+    for name in deleted:
+        hashes.pop(name, None)
+    for name in written:
+        try:
+            hashes[name] = file_digest(os.path.join(directory, name))
+        except OSError:
+            hashes.pop(name, None)
+    with open(os.path.join(directory, '.hashes.json'), 'w', encoding='utf-8') as f:
+        json.dump(hashes, f)
+
+def discard_project_hashes(directory):
+    """Delta aplicado pela metade: sem hashes, a próxima sincronização regrava tudo."""
+    try:
+        os.remove(os.path.join(directory, '.hashes.json'))
+    except OSError:
+        pass
+
+def register_project(project_id, directory, main_file):
+    """
+    Marca o diretório persistente do projeto como base para /compile-delta e
+    remove os projetos menos usados (ou expirados), junto com seus diretórios.
+    """
+    now = time.time()
+    evicted = []
+    with project_cache_lock:
+        project_cache[project_id] = {
+            'directory': directory,
+            'main_file': main_file,
+            'timestamp': now,
+        }
+        project_cache.move_to_end(project_id)
+        for old_id, old in list(project_cache.items())[:-1]:
+            if len(project_cache) <= PROJECT_CACHE_MAX and old['timestamp'] >= now - PROJECT_CACHE_TTL:
+                break
+            # Projeto compilando agora (ou na mesma faixa de lock do chamador): fica
+            # para a próxima rodada. Nunca bloqueia: o chamador já segura um lock.
+            lock = project_lock(old_id)
+            if not lock.acquire(blocking=False):
+                continue
+            del project_cache[old_id]
+            evicted.append((old['directory'], lock))
+    for old_dir, lock in evicted:
+        try:
+            shutil.rmtree(old_dir, ignore_errors=True)
+        finally:
+            lock.release()
+    if evicted:
+        print(f'[Cache] {len(evicted)} projeto(s) removido(s) do cache')
+
+def lookup_project(project_id):
+    """Projeto registrado (marcado como recém-usado) ou None."""
+    with project_cache_lock:
+        info = project_cache.get(project_id)
+        if info is not None:
+            project_cache.move_to_end(project_id)
+            info['timestamp'] = time.time()
+        return info
+
+def cached_main_file(project_id, directory):
+    """Arquivo principal já detectado para o projeto, se ainda existir em directory."""
+    if not project_id:
+        return None
+    with project_cache_lock:
+        info = project_cache.get(project_id)
+        main_file = info.get('main_file') if info else None
+    if main_file and os.path.isfile(os.path.join(directory, main_file)):
+        return main_file
+    return None
+
+def forget_project(project_id):
+    with project_cache_lock:
+        project_cache.pop(project_id, None)
+
+def purge_stale_project_dirs():
+    """
+    Na inicialização o project_cache está vazio: diretórios de projetos de
+    execuções anteriores sem uso há mais de PROJECT_CACHE_TTL são removidos.
+    """
+    projects_dir = os.path.join(CACHE_DIR, 'projects')
+    cutoff = time.time() - PROJECT_CACHE_TTL
+    try:
+        with os.scandir(projects_dir) as it:
+            stale = [entry.path for entry in it
+                     if entry.is_dir(follow_symlinks=False) and entry.stat().st_mtime < cutoff]
+    except OSError:
+        return
+    for path in stale:
+        shutil.rmtree(path, ignore_errors=True)
+
+purge_stale_project_dirs()
+
+def is_safe_member(name):
+    """Rejeita caminhos absolutos ou que escapam do diretório de destino."""
+    normalized = os.path.normpath(name)
+    return not (os.path.isabs(normalized) or normalized == '..'
+                or normalized.startswith('..' + os.sep))
+
+def is_safe_file_name(name):
+    """
+    Nome de arquivo vindo do cliente (JSON): além de is_safe_member, precisa
+    ser texto e apontar para um arquivo, não para o próprio diretório ('',
+    '.') nem para um diretório ('pasta/').
+    """
+    return (isinstance(name, str) and is_safe_member(name)
+            and os.path.normpath(name) != '.'
+            and not name.endswith(('/', os.sep)))
+
+def extract_archive(upload, dest):
+    """
+    Extrai o projeto enviado (ZIP ou .tar.zst) em dest e devolve os caminhos
+    relativos dos arquivos extraídos.
+    Levanta ValueError para arquivos inválidos ou com caminhos inseguros.
+    """
+    extracted = []
+    filename = upload.filename or ''
+    if upload.mimetype == 'application/zstd' or filename.endswith('.tar.zst'):
+        if zstandard is None:
+            raise ValueError('Suporte a .tar.zst indisponível (zstandard não instalado).')
+        extract_kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+        try:
+            reader = zstandard.ZstdDecompressor().stream_reader(upload.stream)
+            budget = MAX_EXTRACTED_SIZE * 1024 * 1024
+            with reader, tarfile.open(fileobj=reader, mode='r|') as tar:
+                for member in tar:
+                    if not (member.isfile() or member.isdir()):
+                        continue
+                    if not is_safe_member(member.name):
+                        raise ValueError(f'Caminho inválido no arquivo: {member.name}')
+                    budget -= member.size
+                    if budget < 0:
+                        raise ValueError(f'Projeto excede {MAX_EXTRACTED_SIZE} MB descompactado.')
+                    tar.extract(member, dest, **extract_kwargs)
+                    if member.isfile():
+                        extracted.append(os.path.normpath(member.name))
+        except (tarfile.TarError, zstandard.ZstdError) as e:
+            raise ValueError(f'Arquivo .tar.zst inválido: {e}')
+        return extracted
+    
+    try:
+        with zipfile.ZipFile(upload, 'r') as z:
+            members = z.infolist()
+            for info in members:
+                if not is_safe_member(info.filename):
+                    raise ValueError(f'Caminho inválido no arquivo: {info.filename}')
+            # Tamanhos declarados limitam o que ZipExtFile devolve: checagem antes de extrair
+            if sum(info.file_size for info in members) > MAX_EXTRACTED_SIZE * 1024 * 1024:
+                raise ValueError(f'Projeto excede {MAX_EXTRACTED_SIZE} MB descompactado.')
+            
+            files = [info for info in members if not info.is_dir()]
+            extracted = [os.path.normpath(info.filename) for info in files]
+            if len(files) < PARALLEL_WRITE_MIN_FILES:
+                z.extractall(dest)
+                return extracted
+            
+            # Diretórios criados antes: z.extract em threads concorrentes disputaria o makedirs
+            parents = {os.path.dirname(os.path.join(dest, info.filename)) for info in members}
+            for parent in parents:
+                os.makedirs(parent, exist_ok=True)
+            # zlib libera o GIL ao inflar: entradas são descompactadas em paralelo
+            list(_write_pool.map(lambda info: z.extract(info, dest), files))
+            return extracted
+    except zipfile.BadZipFile:
+        raise ValueError('Arquivo ZIP inválido.')
+
+def gzip_file_stream(f):
+    """Comprime o arquivo em blocos (gzip), sem carregá-lo inteiro na memória."""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    try:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        f.close()
+
+def zstd_file_stream(f):
+    """Comprime o arquivo em blocos (zstd), sem carregá-lo inteiro na memória."""
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    try:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b''):
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        f.close()
+
+def pick_pdf_encoding(path):
+    """Codificação para o PDF: zstd ou gzip conforme o Accept-Encoding, ou None."""
+    if os.path.getsize(path) < GZIP_MIN_SIZE:
+        return None
+    if zstandard and 'zstd' in request.accept_encodings:
+        return 'zstd'
+    if 'gzip' in request.accept_encodings:
+        return 'gzip'
+    return None
+
+def send_output_file(path, mimetype, download_name, cleanup_dir=None):
+    """
+    Envia arquivo direto do disco (sendfile/Range) sem copiá-lo para memória.
+    PDFs grandes vão comprimidos (zstd ou gzip) quando o cliente aceita.
+    Se cleanup_dir for informado, ele é removido logo após abrir o arquivo.
+    """
+    encoding = pick_pdf_encoding(path) if mimetype == 'application/pdf' else None
+    if encoding:
+        stream = zstd_file_stream if encoding == 'zstd' else gzip_file_stream
+        response = Response(stream(open(path, 'rb')), mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        response.cache_control.no_cache = True
+    else:
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=download_name,
+            conditional=True,
+            max_age=0,
+        )
+    if mimetype == 'application/pdf':
+        response.vary.add('Accept-Encoding')
+    if cleanup_dir:
+        # O arquivo já está aberto: o descritor mantém o conteúdo
+        # acessível até o fim do envio, mesmo com o diretório removido.
+        shutil.rmtree(cleanup_dir, ignore_errors=True)
+    return response
+
+def send_pdf_response(pdf_path, cache_hit=False, compile_ms=0, cleanup_dir=None):
+    """Envia o PDF compilado com os cabeçalhos de diagnóstico do cache."""
+    response = send_output_file(pdf_path, 'application/pdf', 'output.pdf',
+                                cleanup_dir=cleanup_dir)
+    response.headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
+    response.headers['X-Compile-Time-Ms'] = str(int(compile_ms))
+    return response
+
+def read_file_tail(path, size=LOG_TAIL_SIZE, decode=True):
+    """
+    Lê apenas os últimos `size` bytes de um arquivo (sem carregar o resto).
+    Com decode=False devolve bytes, para buscas que não precisam de texto.
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - size, 0))
+            data = f.read()
+    except OSError:
+        data = b''
+    return data.decode('utf-8', 'ignore') if decode else data
+
+# Erros do TeX: "! ...", "arquivo.tex:12: ..." (-file-line-error), contexto "l.12 ..."
+# e mensagens "LaTeX/Package ... Error"
+LOG_ERROR_RE = re.compile(
+    rb'^(?:! .*|[^\s:]+\.(?:tex|sty|cls|ltx|bib|bbl):\d+: .*|l\.\d+ .*|.*\bError\b.*)$',
+    re.MULTILINE)
+
+def extract_log_errors(log_path, limit=MAX_LOG_ERRORS):
+    """Linhas de erro do log da compilação (sem repetir as de passadas seguintes)."""
+    errors = {}
+    try:
+        with open(log_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for match in LOG_ERROR_RE.finditer(mm):
+                    errors[match.group().decode('utf-8', 'replace').rstrip()] = None
+                    if len(errors) >= limit:
+                        break
+    except OSError:
+        return []
+    return list(errors)
+
+def aux_needs_bibtex(aux_path, markers=(b'\\citation', b'\\bibdata')):
+    """Procura \\citation/\\bibdata no .aux via mmap, sem decodificar o arquivo."""
+    try:
+        with open(aux_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return any(mm.find(marker) != -1 for marker in markers)
+    except OSError:
+        return False
+
+def bibtex_targets(work_dir, stem):
+    """
+    .aux (sem extensão) que o BibTeX precisa processar: o principal e, com
+    chapterbib/multibib, os auxiliares que têm seu próprio \\bibdata.
+    """
+    main_aux = os.path.join(work_dir, stem + '.aux')
+    targets = [stem] if aux_needs_bibtex(main_aux) else []
+    for root, _dirs, filenames in os.walk(work_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if (filename.endswith('.aux') and path != main_aux
+                    and aux_needs_bibtex(path, (b'\\bibdata',))):
+                targets.append(os.path.relpath(path, work_dir)[:-4])
+    return targets
+
+@lru_cache(maxsize=None)
+def mylatexformat_available():
+    """mylatexformat.ltx está instalado? (consultado uma vez por processo)"""
+    if not TOOL_PATHS.get('kpsewhich'):
+        return False
+    try:
+        found = subprocess.run(['kpsewhich', 'mylatexformat.ltx'], capture_output=True,
+                               timeout=30, env=COMPILE_ENV)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return found.returncode == 0 and bool(found.stdout.strip())
+
+def _preamble_key(work_dir, main_basename, inputs):
+    """
+    Hash do preâmbulo do arquivo principal + arquivos locais carregados por ele.
+    None só quando não há preâmbulo (sem arquivo principal ou sem \\begin{document}).
+    """
+    h = _new_fingerprint_hash()
+    try:
+        with open(os.path.join(work_dir, main_basename), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = mm.find(b'\\begin{document}')
+                if end == -1:
+                    return None
+                h.update(mm[:end])
+    except OSError:
+        return None
+    for name in inputs:
+        try:
+            with open(os.path.join(work_dir, name), 'rb') as f:
+                _fingerprint_entry(h, name, iter(lambda: f.read(STREAM_CHUNK_SIZE), b''))
+        except OSError:
+            # Entrada removida: a chave muda e o formato é refeito (não desativado)
+            _fingerprint_entry(h, name, (b'\1missing',))
+    return h.hexdigest()
+
+def _local_format_inputs(work_dir, main_basename):
+    """Arquivos do projeto lidos durante a geração do formato (registro .fls)."""
+    inputs = set()
+    try:
+        with open(os.path.join(work_dir, PREAMBLE_FMT_NAME + '.fls'), 'r',
+                  encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if not line.startswith('INPUT '):
+                    continue
+                name = os.path.normpath(line[6:].strip())
+                if is_safe_member(name) and name != main_basename and not name.endswith('.fmt'):
+                    inputs.add(name)
+    except OSError:
+        pass
+    return sorted(inputs)
+
+def _read_preamble_meta(work_dir):
+    try:
+        with open(os.path.join(work_dir, PREAMBLE_FMT_NAME + '.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_preamble_meta(work_dir, meta):
+    with open(os.path.join(work_dir, PREAMBLE_FMT_NAME + '.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+# No despejo \jobname vale PREAMBLE_FMT_NAME e arquivos abertos para escrita não
+# sobrevivem ao .fmt: preâmbulos com isso (índices, glossários, minted, externalize
+# do TikZ, \newwrite/\openout) compilam sempre sem o formato
+PREAMBLE_DUMP_UNSAFE_RE = re.compile(
+    rb'\\(?:jobname|makeindex|makeglossaries|makenomenclature|newwrite|openout'
+    rb'|immediate|tikzexternalize)\b'
+    rb'|\\usepackage\s*(?:\[[^\]]*\])?\s*\{[^}]*\b(?:minted|imakeidx|pythontex)\b')
+
+# Falhas de carga do próprio .fmt (as únicas que justificam recompilar sem ele)
+FORMAT_FAILURE_RE = re.compile(rb"Fatal format file error|I can't find the format file"
+                               rb"|---! \S*\.fmt")
+
+def preamble_dump_safe(work_dir, main_basename):
+    """O preâmbulo do arquivo principal pode ser despejado num .fmt?"""
+    try:
+        with open(os.path.join(work_dir, main_basename), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = mm.find(b'\\begin{document}')
+                return end != -1 and PREAMBLE_DUMP_UNSAFE_RE.search(mm, 0, end) is None
+    except OSError:
+        return False
+
+def prepare_preamble_format(work_dir, main_basename, env):
+    """
+    Pré-compila o preâmbulo do documento num .fmt (mylatexformat), para que as
+    passadas seguintes pulem o carregamento de classe e pacotes. O formato só é
+    refeito quando o preâmbulo (ou um .sty/.tex local que ele carrega) muda.
+    Só para pdflatex: xelatex/lualatex não conseguem despejar o estado das fontes.
+    Retorna o nome do formato ou None.
+    """
+    if not PRECOMPILE_PREAMBLE or not mylatexformat_available():
+        return None
+    
+    meta = _read_preamble_meta(work_dir)
+    key = _preamble_key(work_dir, main_basename, meta.get('inputs', []))
+    if key is None:
+        return None
+    if meta.get('key') == key and meta.get('main') == main_basename:
+        if meta.get('broken'):
+            return None
+        if os.path.isfile(os.path.join(work_dir, PREAMBLE_FMT_NAME + '.fmt')):
+            return PREAMBLE_FMT_NAME
+    
+    if not preamble_dump_safe(work_dir, main_basename):
+        print('[Preamble] Preâmbulo depende de \\jobname ou abre arquivos; sem formato')
+        _write_preamble_meta(work_dir, {'key': key, 'main': main_basename,
+                                        'inputs': meta.get('inputs', []), 'broken': True})
+        return None
+    
+    print('[Preamble] Gerando formato do preâmbulo...')
+    cmd = ['pdflatex', '-ini', '-interaction=batchmode', '-recorder',
+           f'-jobname={PREAMBLE_FMT_NAME}', '&pdflatex', 'mylatexformat.ltx', main_basename]
+    try:
+        subprocess.run(cmd, cwd=work_dir, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, timeout=COMPILE_TIMEOUT, env=env)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f'[Preamble] Falhou: {e}')
+        return None
+    
+    inputs = _local_format_inputs(work_dir, main_basename)
+    meta = {'key': _preamble_key(work_dir, main_basename, inputs),
+            'main': main_basename, 'inputs': inputs}
+    if not os.path.isfile(os.path.join(work_dir, PREAMBLE_FMT_NAME + '.fmt')):
+        print('[Preamble] Preâmbulo não pôde ser despejado; usando compilação normal')
+        meta['broken'] = True
+        _write_preamble_meta(work_dir, meta)
+        return None
+    _write_preamble_meta(work_dir, meta)
+    return PREAMBLE_FMT_NAME
+
+def mark_preamble_format_broken(work_dir):
+    """O documento só compila sem o formato: não usar até o preâmbulo mudar."""
+    meta = _read_preamble_meta(work_dir)
+    if meta:
+        meta['broken'] = True
+        _write_preamble_meta(work_dir, meta)
+
+AUX_BIB_RE = re.compile(rb'\\(?:citation|bibdata|bibstyle)\{[^}]*\}')
+
+def bibliography_signature(work_dir):
+    """
+    Hash do que determina o .bbl: conteúdo dos .bib e dos .bst locais e as
+    linhas \\citation/\\bibdata/\\bibstyle de todos os .aux do projeto.
+    """
+    bib_files, aux_files = [], []
+    for root, _dirs, filenames in os.walk(work_dir):
+        for filename in filenames:
+            if filename.endswith(('.bib', '.bst')):
+                bib_files.append(os.path.join(root, filename))
+            elif filename.endswith('.aux'):
+                aux_files.append(os.path.join(root, filename))
+    
+    h = _new_fingerprint_hash()
+    for path in sorted(bib_files):
+        with open(path, 'rb') as f:
+            _fingerprint_entry(h, os.path.relpath(path, work_dir),
+                               iter(lambda: f.read(STREAM_CHUNK_SIZE), b''))
+    for path in sorted(aux_files):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                _fingerprint_entry(h, os.path.relpath(path, work_dir), AUX_BIB_RE.findall(mm))
+    return h.hexdigest()
+
+def run_latexmk(work_dir, main_basename, engine, env, log_file, fmt=None):
+    """
+    Compila com latexmk, que decide quantas passadas rodar e se BibTeX/Biber/
+    makeindex são necessários a partir dos registros .fls/.fdb_latexmk.
+    """
+    cmd = [LATEXMK_CMD, LATEXMK_ENGINE_FLAGS[engine], '-interaction=nonstopmode',
+           '-file-line-error', '-recorder', main_basename]
+    if fmt:
+        cmd.insert(1, f'-pdflatex=pdflatex -fmt={fmt} %O %S')
+    print('[Cloud Compile] latexmk...')
+    # Sessão própria: no timeout o grupo inteiro morre, não só o latexmk
+    # (pdflatex/bibtex/biber filhos continuariam gravando no diretório)
+    proc = subprocess.Popen(
+        cmd, cwd=work_dir, stdout=log_file, stderr=subprocess.STDOUT,
+        env=env, start_new_session=True,
+    )
+    try:
+        proc.wait(timeout=COMPILE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+        raise
+
+# Avisos de rerun do kernel (referências), hyperref/rerunfilecheck (outlines),
+# natbib (citações), longtable e biblatex ("Please rerun LaTeX")
+RERUN_RE = re.compile(rb'Rerun to get|[Rr]erun LaTeX')
+
+def run_latex_passes(base_cmd, work_dir, main_basename, env, log_file):
+    """Pipeline manual (sem latexmk): passo 1, BibTeX se preciso, passos 2 e 3."""
+    stem = os.path.splitext(main_basename)[0]
+    # O aviso de rerun fica no fim do .log que o motor reescreve a cada passada
+    engine_log = os.path.join(work_dir, stem + '.log')
+    
+    def needs_another_pass():
+        return RERUN_RE.search(read_file_tail(engine_log, RERUN_SCAN_SIZE,
+                                              decode=False)) is not None
+    
+    def run_pass(cmd, header, timeout):
+        log_file.write(header)
+        log_file.flush()
+        return subprocess.run(
+            cmd, cwd=work_dir, stdout=log_file, stderr=subprocess.STDOUT,
+            timeout=timeout, env=env,
+        ).returncode
+    
+    def run_bibtex(targets):
+        # Bibliografias independentes (chapterbib/multibib) rodam em paralelo
+        log_file.write(b'\n--- BibTeX ---\n')
+        log_file.flush()
+        procs = [subprocess.Popen([BIBTEX_CMD, target], cwd=work_dir, stdout=log_file,
+                                  stderr=subprocess.STDOUT, env=env)
+                 for target in targets]
+        deadline = time.monotonic() + 60
+        try:
+            return max(proc.wait(timeout=max(deadline - time.monotonic(), 0)) for proc in procs)
+        except subprocess.TimeoutExpired:
+            for proc in procs:
+                proc.kill()
+                proc.wait()
+            raise
+    
+    # Passo 1
+    print('[Cloud Compile] Pass 1...')
+    run_pass(base_cmd, b'', COMPILE_TIMEOUT)
+    
+    needs_rerun = needs_another_pass()
+    targets = bibtex_targets(work_dir, stem)
+    
+    # BibTeX: em projetos persistentes o .bbl anterior vale enquanto
+    # os .bib, os .bst locais e as citações não mudarem
+    if targets and TOOL_PATHS.get(BIBTEX_CMD):
+        signature_path = os.path.join(work_dir, BIB_SIGNATURE_NAME)
+        signature = bibliography_signature(work_dir)
+        try:
+            with open(signature_path, 'r', encoding='ascii') as f:
+                unchanged = f.read() == signature
+        except OSError:
+            unchanged = False
+        
+        if unchanged and all(os.path.isfile(os.path.join(work_dir, target + '.bbl'))
+                             for target in targets):
+            print('[Cloud Compile] Bibliografia inalterada, BibTeX pulado')
+        else:
+            print(f'[Cloud Compile] Running BibTeX ({len(targets)} aux)...')
+            # Status 1 = só avisos (campo vazio etc.): o .bbl é válido
+            if run_bibtex(targets) <= 1:
+                with open(signature_path, 'w', encoding='ascii') as f:
+                    f.write(signature)
+            needs_rerun = True
+    
+    # Passos 2 e 3
+    if needs_rerun:
+        for i in range(2):
+            print(f'[Cloud Compile] Pass {i + 2}...')
+            run_pass(base_cmd, f'\n--- Pass {i + 2} ---\n'.encode(), COMPILE_TIMEOUT)
+            if not needs_another_pass():
+                break
 
 def compile_project(directory, main_file, engine=None, project_id=None):
     """
     Pipeline de compilação LaTeX otimizado para cloud.
+    Usa latexmk quando disponível; senão, o pipeline manual de passadas.
     """
     engine = engine if engine in SUPPORTED_ENGINES else DEFAULT_ENGINE
     
-    if not shutil.which(engine):
+    if not TOOL_PATHS.get(engine):
         return {
             'success': False,
             'log': f'Motor LaTeX "{engine}" não encontrado.',
@@ -199,61 +1055,46 @@ def compile_project(directory, main_file, engine=None, project_id=None):
     work_dir = os.path.dirname(main_path) or directory
     main_basename = os.path.basename(main_file)
     
-    base_cmd = [engine, '-interaction=nonstopmode', '-file-line-error',
-                '-enable-installer', main_basename]
+    env = COMPILE_ENV
     
-    env = os.environ.copy()
-    env['MIKTEX_ENABLEINSTALLER'] = 't'
-    env['TEXMFVAR'] = '/tmp/texmf-var'  # Evita problemas de permissão
+    # Projeto persistente: o preâmbulo pré-compilado sobrevive entre requisições
+    fmt = None
+    if project_id and engine == 'pdflatex':
+        fmt = prepare_preamble_format(work_dir, main_basename, env)
     
-    full_log = ''
+    # Em diretórios persistentes, um PDF antigo não pode passar por sucesso
+    actual_pdf = os.path.join(work_dir, os.path.splitext(main_basename)[0] + '.pdf')
+    if os.path.isfile(actual_pdf):
+        os.remove(actual_pdf)
+    
+    # Saída de todas as passadas vai para disco; só a cauda volta para o Python
+    log_path = os.path.join(work_dir, COMPILE_LOG_NAME)
     print(f'[Cloud Compile] Engine: {engine}, Main: {main_file}')
     
+    def run_build(fmt):
+        with open(log_path, 'wb') as log_file:
+            if TOOL_PATHS.get(LATEXMK_CMD):
+                run_latexmk(work_dir, main_basename, engine, env, log_file, fmt)
+            else:
+                base_cmd = [engine, '-interaction=nonstopmode', '-file-line-error',
+                            '-enable-installer', main_basename]
+                if fmt:
+                    base_cmd.insert(1, f'-fmt={fmt}')
+                run_latex_passes(base_cmd, work_dir, main_basename, env, log_file)
+    
     try:
-        # Passo 1
-        print('[Cloud Compile] Pass 1...')
-        r1 = subprocess.run(
-            base_cmd, cwd=work_dir, capture_output=True, text=True,
-            timeout=COMPILE_TIMEOUT, env=env,
-        )
-        full_log += r1.stdout + '\n' + r1.stderr
-        
-        needs_bib = False
-        needs_rerun = 'Rerun to get cross-references right' in r1.stdout
-        
-        aux_path = os.path.join(work_dir, os.path.splitext(main_basename)[0] + '.aux')
-        if os.path.isfile(aux_path):
-            try:
-                aux_content = open(aux_path, 'r', encoding='utf-8', errors='ignore').read()
-                needs_bib = '\\citation' in aux_content or '\\bibdata' in aux_content
-            except Exception:
-                pass
-        
-        # BibTeX
-        if needs_bib and shutil.which(BIBTEX_CMD):
-            bib_base = os.path.splitext(main_basename)[0]
-            print('[Cloud Compile] Running BibTeX...')
-            rb = subprocess.run(
-                [BIBTEX_CMD, bib_base], cwd=work_dir, capture_output=True,
-                text=True, timeout=60, env=env,
-            )
-            full_log += '\n--- BibTeX ---\n' + rb.stdout + '\n' + rb.stderr
-            needs_rerun = True
-        
-        # Passos 2 e 3
-        if needs_rerun:
-            for i in range(2):
-                print(f'[Cloud Compile] Pass {i + 2}...')
-                ri = subprocess.run(
-                    base_cmd, cwd=work_dir, capture_output=True, text=True,
-                    timeout=COMPILE_TIMEOUT, env=env,
-                )
-                full_log += f'\n--- Pass {i + 2} ---\n' + ri.stdout + '\n' + ri.stderr
-                if 'Rerun to get cross-references right' not in ri.stdout:
-                    break
+        run_build(fmt)
+        if (fmt and not os.path.isfile(actual_pdf)
+                and FORMAT_FAILURE_RE.search(read_file_tail(log_path, decode=False))):
+            # O .fmt não carregou: tenta sem ele. Erros do próprio documento não
+            # repetem a compilação inteira.
+            print('[Preamble] Formato pré-compilado não carregou; recompilando sem ele')
+            run_build(None)
+            if os.path.isfile(actual_pdf):
+                mark_preamble_format_broken(work_dir)
+        full_log = read_file_tail(log_path)
         
         # Verificar resultado
-        actual_pdf = os.path.join(work_dir, os.path.splitext(main_basename)[0] + '.pdf')
         if os.path.isfile(actual_pdf):
             size_mb = os.path.getsize(actual_pdf) / (1024 * 1024)
             print(f'[Cloud Compile] [OK] PDF gerado ({size_mb:.1f} MB)')
@@ -272,17 +1113,247 @@ def compile_project(directory, main_file, engine=None, project_id=None):
             }
         else:
             print('[Cloud Compile] [ERR] PDF não gerado')
-            return {'success': False, 'log': full_log}
+            return {'success': False, 'log': full_log, 'errors': extract_log_errors(log_path)}
             
     except subprocess.TimeoutExpired:
-        return {'success': False, 'log': f'Timeout ({COMPILE_TIMEOUT}s) expirado.'}
+        # Devolve também o que as passadas já tinham escrito antes do timeout
+        tail = read_file_tail(log_path, LOG_TAIL_SIZE - 100)
+        return {'success': False, 'log': f'{tail}\nTimeout ({COMPILE_TIMEOUT}s) expirado.',
+                'errors': extract_log_errors(log_path)}
     except Exception as e:
         return {'success': False, 'log': f'Erro: {str(e)}'}
 
+def warmup_latex(engine=DEFAULT_ENGINE):
+    """
+    Compila um documento vazio para carregar o .fmt e popular o TEXMFVAR,
+    tirando esse custo da primeira compilação real.
+    """
+    if not TOOL_PATHS.get(engine):
+        return
+    warm_dir = tempfile.mkdtemp(prefix='olc_warmup_',
+                                dir='/dev/shm' if os.access('/dev/shm', os.W_OK) else None)
+    try:
+        with open(os.path.join(warm_dir, 'warmup.tex'), 'w', encoding='utf-8') as f:
+            f.write('\\documentclass{article}\\begin{document}\\end{document}\n')
+        subprocess.run(
+            [engine, '-interaction=batchmode', 'warmup.tex'], cwd=warm_dir,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            timeout=60, env=COMPILE_ENV,
+        )
+        print(f'[Warmup] {engine} pronto')
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f'[Warmup] Falhou: {e}')
+    finally:
+        shutil.rmtree(warm_dir, ignore_errors=True)
+
+# ═══════════════════════════════════════════════════════════════════
+#  PDF Cache (conteúdo idêntico → mesmo PDF, sem recompilar)
+# ═══════════════════════════════════════════════════════════════════
+
+# Índice em memória fingerprint -> tamanho, em ordem de uso (LRU).
+# Evita listar o diretório do cache a cada PDF gravado.
+pdf_cache_index = OrderedDict()
+pdf_cache_bytes = 0
+pdf_cache_lock = threading.Lock()
+
+def _new_fingerprint_hash():
+    # Chave de cache, não assinatura: xxh3 é ~10x mais rápido que sha256
+    if xxhash:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=16)
+
+def _fingerprint_entry(h, name, chunks):
+    h.update(name.encode('utf-8'))
+    h.update(b'\0')
+    for chunk in chunks:
+        h.update(chunk)
+    h.update(b'\0')
+
+def project_fingerprint(files, engine, main_file):
+    """Chave do cache de PDFs para arquivos enviados como JSON."""
+    h = _new_fingerprint_hash()
+    _fingerprint_entry(h, engine, ())
+    _fingerprint_entry(h, main_file, ())
+    for name in sorted(files):
+        content = files[name]
+        _fingerprint_entry(h, name, (content.encode('utf-8') if isinstance(content, str) else content,))
+    return h.hexdigest()
+
+def tree_fingerprint(directory, engine, main_file):
+    """Chave do cache de PDFs para um projeto já extraído em disco."""
+    names = []
+    for root, _dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            names.append(os.path.relpath(os.path.join(root, filename), directory))
+    
+    h = _new_fingerprint_hash()
+    _fingerprint_entry(h, engine, ())
+    _fingerprint_entry(h, main_file, ())
+    for name in sorted(names):
+        with open(os.path.join(directory, name), 'rb') as f:
+            _fingerprint_entry(h, name, iter(lambda: f.read(STREAM_CHUNK_SIZE), b''))
+    return h.hexdigest()
+
+def _pdf_cache_path(fingerprint):
+    return os.path.join(CACHE_DIR, 'pdfs', fingerprint + '.pdf')
+
+def load_pdf_cache_index():
+    """Reconstrói o índice LRU a partir dos PDFs que já estão no disco (CACHE_DIR persistente)."""
+    global pdf_cache_bytes
+    cache_dir = os.path.join(CACHE_DIR, 'pdfs')
+    entries = []
+    try:
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.pdf') and entry.is_file():
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.name[:-4], st.st_size))
+    except OSError:
+        return
+    with pdf_cache_lock:
+        for _mtime, fingerprint, size in sorted(entries):
+            pdf_cache_index[fingerprint] = size
+            pdf_cache_bytes += size
+    evict_pdf_cache()
+
+def get_cached_pdf(fingerprint):
+    """Retorna o PDF em cache (e marca como recém-usado) ou None."""
+    with pdf_cache_lock:
+        if fingerprint not in pdf_cache_index:
+            return None
+        pdf_cache_index.move_to_end(fingerprint)
+    path = _pdf_cache_path(fingerprint)
+    if not os.path.isfile(path):
+        _forget_cached_pdf(fingerprint)
+        return None
+    return path
+
+def _forget_cached_pdf(fingerprint):
+    global pdf_cache_bytes
+    with pdf_cache_lock:
+        size = pdf_cache_index.pop(fingerprint, None)
+        if size is not None:
+            pdf_cache_bytes -= size
+
+def store_cached_pdf(fingerprint, pdf_path):
+    """
+    Copia o PDF gerado para o cache e aplica os limites de tamanho/entradas.
+    Devolve o caminho da cópia no cache, ou None se ela não ficou no cache.
+    """
+    global pdf_cache_bytes
+    cache_dir = os.path.join(CACHE_DIR, 'pdfs')
+    os.makedirs(cache_dir, exist_ok=True)
+    target = _pdf_cache_path(fingerprint)
+    tmp_path = f'{target}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        copy_file_fast(pdf_path, tmp_path)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, target)  # Leitores nunca veem um PDF pela metade
+    except OSError as e:
+        print(f'[PDF Cache] Erro ao gravar: {e}')
+        return None
+    with pdf_cache_lock:
+        pdf_cache_bytes += size - pdf_cache_index.pop(fingerprint, 0)
+        pdf_cache_index[fingerprint] = size
+    evict_pdf_cache()
+    with pdf_cache_lock:
+        return target if fingerprint in pdf_cache_index else None
+
+def evict_pdf_cache():
+    """Remove os PDFs usados há mais tempo até caber nos limites do cache."""
+    global pdf_cache_bytes
+    evicted = []
+    with pdf_cache_lock:
+        while pdf_cache_index and (len(pdf_cache_index) > PDF_CACHE_MAX_ENTRIES
+                                   or pdf_cache_bytes > PDF_CACHE_MAX_BYTES):
+            fingerprint, size = pdf_cache_index.popitem(last=False)
+            pdf_cache_bytes -= size
+            evicted.append(fingerprint)
+    for fingerprint in evicted:
+        try:
+            os.remove(_pdf_cache_path(fingerprint))
+        except OSError:
+            pass
+
+load_pdf_cache_index()
+
+# ═══════════════════════════════════════════════════════════════════
+#  Compilação assíncrona (POST /compile com "async": true)
+# ═══════════════════════════════════════════════════════════════════
+
+# As passadas rodam em subprocessos: threads bastam para esperar por elas
+_job_pool = ThreadPoolExecutor(max_workers=COMPILE_JOB_WORKERS, thread_name_prefix='olc-job')
+compile_jobs = {}  # job_id -> {future, cleanup_dir, finished}
+compile_jobs_lock = threading.Lock()
+
+def timed_compile(work_dir, main_file, engine, project_id, fingerprint):
+    """Compila, guarda o PDF no cache e devolve (resultado, duração em ms)."""
+    started = time.monotonic()
+    result = compile_project(work_dir, main_file, engine, project_id)
+    compile_ms = (time.monotonic() - started) * 1000
+    if result['success']:
+        cached = store_cached_pdf(fingerprint, result['pdf_path'])
+        if cached and project_id:
+            # O PDF do diretório persistente some na próxima compilação do projeto;
+            # a cópia do cache só é substituída atomicamente
+            result['pdf_path'] = cached
+    return result, compile_ms
+
+def submit_compile_job(cleanup_dir, build):
+    """Enfileira build() (que devolve o mesmo que timed_compile) e devolve o id do job."""
+    sweep_compile_jobs()
+    job_id = uuid.uuid4().hex
+    future = _job_pool.submit(build)
+    job = {'future': future, 'cleanup_dir': cleanup_dir, 'finished': None}
+    future.add_done_callback(lambda _f: job.update(finished=time.time()))
+    with compile_jobs_lock:
+        compile_jobs[job_id] = job
+    return job_id
+
+def sweep_compile_jobs():
+    """Descarta resultados que ninguém buscou em COMPILE_JOB_TTL segundos."""
+    cutoff = time.time() - COMPILE_JOB_TTL
+    with compile_jobs_lock:
+        expired = [job_id for job_id, job in compile_jobs.items()
+                   if job['finished'] and job['finished'] < cutoff]
+        expired_jobs = [compile_jobs.pop(job_id) for job_id in expired]
+    for job in expired_jobs:
+        if job['cleanup_dir']:
+            shutil.rmtree(job['cleanup_dir'], ignore_errors=True)
+
 # ═══════════════════════════════════════════════════════════════════
 #  PDF to Word Conversion
 # ═══════════════════════════════════════════════════════════════════
 
+_convert_pool = None
+_convert_pool_lock = threading.Lock()
+_libreoffice_lock = threading.Lock()
+
+def get_convert_pool():
+    """
+    Pool de processos (criado sob demanda) para conversões com pdf2docx.
+    Workers via forkserver: fork() de um processo com threads (gthread,
+    pools de escrita e de jobs) pode herdar locks presos.
+    """
+    global _convert_pool
+    with _convert_pool_lock:
+        if _convert_pool is None:
+            _convert_pool = ProcessPoolExecutor(max_workers=CONVERT_WORKERS,
+                                                mp_context=multiprocessing.get_context('forkserver'),
+                                                initializer=convert_worker.warm_pdf2docx)
+        return _convert_pool
+
+def discard_convert_pool(pool):
+    """
+    Tira de uso um pool quebrado (worker morto por OOM ou segfault); o
+    próximo get_convert_pool() cria outro.
+    """
+    global _convert_pool
+    with _convert_pool_lock:
+        if _convert_pool is pool:
+            _convert_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
 def convert_pdf_to_word(pdf_path):
     """
     Converte PDF para DOCX usando LibreOffice ou pandoc.
@@ -293,22 +1364,27 @@ def convert_pdf_to_word(pdf_path):
     docx_path = os.path.join(output_dir, f"{base_name}.docx")
     
     # Estratégia 1: LibreOffice (melhor qualidade para LaTeX)
-    if shutil.which('libreoffice'):
+    if TOOL_PATHS.get('libreoffice'):
         try:
             print(f'[Convert] Tentando LibreOffice...')
             cmd = [
                 'libreoffice', 
+                f'-env:UserInstallation={LIBREOFFICE_PROFILE}',
                 '--headless', 
+                '--nologo',
+                '--norestore',
                 '--convert-to', 'docx',
                 '--outdir', output_dir,
                 pdf_path
             ]
-            result = subprocess.run(
-                cmd, 
-                capture_output=True, 
-                text=True, 
-                timeout=60
-            )
+            # Um soffice por perfil: conversões simultâneas no mesmo perfil falham
+            with _libreoffice_lock:
+                result = subprocess.run(
+                    cmd, 
+                    capture_output=True, 
+                    text=True, 
+                    timeout=60
+                )
             if result.returncode == 0 and os.path.isfile(docx_path):
                 print(f'[Convert] LibreOffice sucesso: {docx_path}')
                 return docx_path
@@ -318,7 +1394,7 @@ def convert_pdf_to_word(pdf_path):
             print(f'[Convert] LibreOffice erro: {e}')
     
     # Estratégia 2: Pandoc (se disponível)
-    if shutil.which('pandoc'):
+    if TOOL_PATHS.get('pandoc'):
         try:
             print(f'[Convert] Tentando pandoc...')
             # Pandoc funciona melhor com LaTeX direto, mas tentamos PDF
@@ -343,18 +1419,26 @@ def convert_pdf_to_word(pdf_path):
         except Exception as e:
             print(f'[Convert] Pandoc erro: {e}')
     
-    # Estratégia 3: pdf2docx (biblioteca Python)
+    # Estratégia 3: pdf2docx (biblioteca Python), fora da thread do Flask
     try:
-        from pdf2docx import Converter
         print(f'[Convert] Tentando pdf2docx...')
-        cv = Converter(pdf_path)
-        cv.convert(docx_path, start=0, end=None)
-        cv.close()
+        pool = get_convert_pool()
+        future = pool.submit(convert_worker.pdf2docx_convert, pdf_path, docx_path, COMPILE_TIMEOUT)
+        # O worker se interrompe em COMPILE_TIMEOUT; a folga cobre a fila do pool
+        future.result(timeout=COMPILE_TIMEOUT + CONVERT_QUEUE_GRACE)
         if os.path.isfile(docx_path):
             print(f'[Convert] pdf2docx sucesso: {docx_path}')
             return docx_path
     except ImportError:
         print('[Convert] pdf2docx não instalado')
+    except FutureTimeoutError:
+        # Os outros workers seguem atendendo; este libera quando o alarme disparar
+        future.cancel()
+        print(f'[Convert] pdf2docx timeout ({COMPILE_TIMEOUT}s)')
+    except BrokenProcessPool as e:
+        # Worker morreu (OOM, segfault): sem recriar, o pdf2docx ficaria quebrado até o restart
+        print(f'[Convert] pdf2docx: pool quebrado ({e}); recriando')
+        discard_convert_pool(pool)
     except Exception as e:
         print(f'[Convert] pdf2docx erro: {e}')
     
@@ -388,6 +1472,7 @@ LANDING_PAGE = """
     <ul>
         <li><code>GET /status</code> - Health check</li>
         <li><code>POST /compile</code> - Compilar arquivos JSON</li>
+        <li><code>GET /compile/&lt;id&gt;</code> - Resultado de compilação assíncrona</li>
         <li><code>POST /compile-zip</code> - Compilar ZIP</li>
         <li><code>POST /compile-delta</code> - Compilação incremental (delta)</li>
         <li><code>POST /convert/word</code> - Converter PDF para DOCX</li>
@@ -397,25 +1482,30 @@ LANDING_PAGE = """
 </html>
 """
 
+# Motores e configuração não mudam em runtime: página e status montados uma vez
+LANDING_HTML = app.jinja_env.from_string(LANDING_PAGE).render(
+    engines=detect_available_engines()).encode('utf-8')
+
+STATUS_JSON = json.dumps({
+    'status': 'ok',
+    'engines': detect_available_engines(),
+    'default_engine': DEFAULT_ENGINE,
+    'compile_timeout': COMPILE_TIMEOUT,
+    'cloud_storage': USE_CLOUD_STORAGE,
+    'version': '2.1.0-cloud',
+    'features': ['compile', 'compile-async', 'compile-zip', 'compile-delta', 'convert-word'],
+    'archive_formats': ['zip'] + (['tar.zst'] if zstandard else [])
+}).encode('utf-8')
+
 @app.route('/')
 def index():
     """Página inicial com status."""
-    engines = detect_available_engines()
-    return render_template_string(LANDING_PAGE, engines=engines)
+    return Response(LANDING_HTML, mimetype='text/html')
 
 @app.route('/status', methods=['GET'])
 def status():
     """Health check endpoint."""
-    engines = detect_available_engines()
-    return jsonify({
-        'status': 'ok',
-        'engines': engines,
-        'default_engine': DEFAULT_ENGINE,
-        'compile_timeout': COMPILE_TIMEOUT,
-        'cloud_storage': USE_CLOUD_STORAGE,
-        'version': '2.1.0-cloud',
-        'features': ['compile', 'compile-zip', 'compile-delta', 'convert-word']
-    })
+    return Response(STATUS_JSON, mimetype='application/json')
 
 @app.route('/compile', methods=['POST'])
 @require_auth
@@ -430,41 +1520,115 @@ def compile_latex():
     main_file = data.get('mainFile', 'main.tex')
     engine = data.get('engine', DEFAULT_ENGINE)
     project_id = data.get('projectId')
+    run_async = bool(data.get('async'))
     
     if not files:
         return jsonify({'error': 'Nenhum arquivo recebido.'}), 400
     
-    # Usar diretório temporário em /tmp (escrita permitida em Cloud Run)
-    with tempfile.TemporaryDirectory(dir='/tmp', prefix='olc_') as work_dir:
-        # Escrever arquivos
-        for filename, content in files.items():
-            filepath = os.path.join(work_dir, filename)
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(content)
-        
-        result = compile_project(work_dir, main_file, engine, project_id)
+    # Nomes vêm do cliente: nada pode ser gravado fora do diretório do projeto
+    for name in (main_file, *files):
+        if not is_safe_file_name(name):
+            return jsonify({'error': f'Caminho inválido: {name}'}), 400
+    
+    fingerprint = project_fingerprint(files, engine, main_file)
+    if not project_id:
+        cached_pdf = get_cached_pdf(fingerprint)
+        if cached_pdf:
+            print('[PDF Cache] HIT')
+            return send_pdf_response(cached_pdf, cache_hit=True)
+    
+    if project_id:
+        # Diretório persistente: só reescreve o que mudou desde a última compilação
+        work_dir = get_project_cache_dir(project_id)
+        cleanup_dir = None
+    else:
+        # Usar diretório temporário em /tmp (escrita permitida em Cloud Run).
+        # A limpeza fica a cargo de send_output_file (ou do caminho de erro).
+        work_dir = tempfile.mkdtemp(dir='/tmp', prefix='olc_')
+        cleanup_dir = work_dir
+    
+    def build(detach_dir=None, respond=None):
+        """(resultado, ms) do timed_compile, ou respond(resultado, ms) se informado."""
+        if not project_id:
+            write_project_files(work_dir, files)
+            result, compile_ms = timed_compile(work_dir, main_file, engine, project_id, fingerprint)
+            return respond(result, compile_ms) if respond else (result, compile_ms)
+        # Sincronização e compilação sob o mesmo lock: outra requisição do projeto
+        # não troca os arquivos no meio da compilação (nem o PDF guardado no cache)
+        # O cache só é consultado depois: o diretório e a base do /compile-delta
+        # precisam refletir as fontes recebidas mesmo num HIT
+        with project_lock(project_id):
+            sync_project_files(work_dir, files)
+            register_project(project_id, work_dir, main_file)
+            cached_pdf = get_cached_pdf(fingerprint)
+            if cached_pdf:
+                print('[PDF Cache] HIT')
+                result, compile_ms = {'success': True, 'pdf_path': cached_pdf, 'cache_hit': True}, 0
+            else:
+                result, compile_ms = timed_compile(work_dir, main_file, engine, project_id,
+                                                   fingerprint)
+            if detach_dir and result['success']:
+                # Job assíncrono: até o cliente buscar, o main.pdf do projeto pode ser
+                # regerado e a entrada do cache de PDFs despejada (LRU)
+                detached = os.path.join(detach_dir, 'output.pdf')
+                try:
+                    os.link(result['pdf_path'], detached)
+                except OSError:
+                    copy_file_fast(result['pdf_path'], detached)
+                result['pdf_path'] = detached
+            # A resposta abre o PDF ainda com o lock: fora do cache ele é o main.pdf
+            # do projeto, que a próxima compilação apaga e regera
+            return respond(result, compile_ms) if respond else (result, compile_ms)
+    
+    try:
+        if run_async:
+            # Não segura a conexão durante a compilação: o cliente consulta /compile/<id>
+            job_dir = cleanup_dir or tempfile.mkdtemp(dir='/tmp', prefix='olc_job_')
+            job_id = submit_compile_job(job_dir, lambda: build(job_dir))
+            return jsonify({'job_id': job_id, 'poll': f'/compile/{job_id}'}), 202
         
-        if result['success']:
-            with open(result['pdf_path'], 'rb') as f:
-                pdf_data = io.BytesIO(f.read())
-            
-            response = send_file(
-                pdf_data,
-                mimetype='application/pdf',
-                as_attachment=True,
-                download_name='output.pdf'
-            )
-            
-            # Adicionar headers CORS
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            return response
-        else:
-            return jsonify({
-                'error': 'Compilação falhou.',
-                'log': result['log'][-5000:],  # Aumentado para cloud
-                'public_url': result.get('public_url')
-            }), 500
+        return build(respond=lambda result, compile_ms:
+                     compile_response(result, compile_ms, cleanup_dir))
+    except Exception:
+        if cleanup_dir:
+            shutil.rmtree(cleanup_dir, ignore_errors=True)
+        raise
+
+def compile_response(result, compile_ms, cleanup_dir):
+    """PDF compilado ou o erro com a cauda do log; remove cleanup_dir em ambos os casos."""
+    if result['success']:
+        return send_pdf_response(result['pdf_path'], cache_hit=result.get('cache_hit', False),
+                                 compile_ms=compile_ms, cleanup_dir=cleanup_dir)
+    
+    if cleanup_dir:
+        shutil.rmtree(cleanup_dir, ignore_errors=True)
+    return jsonify({
+        'error': 'Compilação falhou.',
+        'errors': result.get('errors', []),
+        'log': result['log'],  # Já limitado a LOG_TAIL_SIZE
+        'public_url': result.get('public_url')
+    }), 500
+
+@app.route('/compile/<job_id>', methods=['GET'])
+@require_auth
+def compile_job_status(job_id):
+    """Resultado de uma compilação assíncrona: 202 enquanto roda, depois o PDF (uma vez)."""
+    sweep_compile_jobs()
+    with compile_jobs_lock:
+        job = compile_jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'JOB_NOT_FOUND', 'message': 'Job inexistente ou já entregue.'}), 404
+        if not job['future'].done():
+            return jsonify({'job_id': job_id, 'status': 'running'}), 202
+        del compile_jobs[job_id]
+    
+    try:
+        result, compile_ms = job['future'].result()
+        return compile_response(result, compile_ms, job['cleanup_dir'])
+    except Exception:
+        if job['cleanup_dir']:
+            shutil.rmtree(job['cleanup_dir'], ignore_errors=True)
+        raise
 
 @app.route('/compile-zip', methods=['POST'])
 @require_auth
@@ -481,40 +1645,49 @@ def compile_zip():
     engine = request.form.get('engine', DEFAULT_ENGINE)
     project_id = request.form.get('projectId')
     
-    with tempfile.TemporaryDirectory(dir='/tmp', prefix='olc_zip_') as tmp_dir:
+    tmp_dir = tempfile.mkdtemp(dir='/tmp', prefix='olc_zip_')
+    try:
         extract_dir = os.path.join(tmp_dir, 'project')
         os.makedirs(extract_dir, exist_ok=True)
         
         try:
-            with zipfile.ZipFile(zip_file, 'r') as z:
-                z.extractall(extract_dir)
-        except zipfile.BadZipFile:
-            return jsonify({'error': 'Arquivo ZIP inválido.'}), 400
+            extract_archive(zip_file, extract_dir)
+        except ValueError as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return jsonify({'error': str(e)}), 400
         
-        main_file = find_main_file(extract_dir)
+        # Recompilações do mesmo projeto pulam a varredura de .tex
+        main_file = cached_main_file(project_id, extract_dir) or find_main_file(extract_dir)
         if not main_file:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
             return jsonify({'error': 'Nenhum arquivo .tex encontrado no ZIP.'}), 400
         
-        result = compile_project(extract_dir, main_file, engine, project_id)
+        fingerprint = tree_fingerprint(extract_dir, engine, main_file)
+        cached_pdf = get_cached_pdf(fingerprint)
         
-        if result['success']:
-            with open(result['pdf_path'], 'rb') as f:
-                pdf_data = io.BytesIO(f.read())
-            
-            response = send_file(
-                pdf_data,
-                mimetype='application/pdf',
-                as_attachment=True,
-                download_name='output.pdf'
-            )
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            return response
+        if not project_id:
+            if cached_pdf:
+                print('[PDF Cache] HIT')
+                return send_pdf_response(cached_pdf, cache_hit=True, cleanup_dir=tmp_dir)
+            result, compile_ms = timed_compile(extract_dir, main_file, engine, None, fingerprint)
+            return compile_response(result, compile_ms, tmp_dir)
         else:
-            return jsonify({
-                'error': 'Compilação falhou.',
-                'log': result['log'][-5000:],
-                'public_url': result.get('public_url')
-            }), 500
+            # Compila no diretório persistente: latexmk reaproveita .aux/.fdb_latexmk
+            # e as próximas chamadas de /compile-delta partem deste estado
+            with project_lock(project_id):
+                work_dir = get_project_cache_dir(project_id)
+                sync_project_tree(extract_dir, work_dir)
+                register_project(project_id, work_dir, main_file)
+                if cached_pdf:
+                    print('[PDF Cache] HIT')
+                    return send_pdf_response(cached_pdf, cache_hit=True, cleanup_dir=tmp_dir)
+                result, compile_ms = timed_compile(work_dir, main_file, engine, project_id,
+                                                   fingerprint)
+                # Resposta montada (PDF aberto) antes de liberar o lock do projeto
+                return compile_response(result, compile_ms, tmp_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
 
 @app.route('/compile-delta', methods=['POST'])
 @require_auth
@@ -538,59 +1711,67 @@ def compile_delta():
         return jsonify({'error': 'projectId é obrigatório para compilação delta.'}), 400
     
     # Verificar se temos o projeto em cache
-    if project_id not in project_cache:
+    cache_info = lookup_project(project_id)
+    if cache_info is None:
         return jsonify({'error': 'CACHE_MISS', 'message': 'Projeto não encontrado no cache.'}), 410
     
-    cache_info = project_cache[project_id]
+    with project_lock(project_id):
+        return apply_delta_and_compile(project_id, cache_info, delta_file,
+                                       deleted_files, engine)
+
+def apply_delta_and_compile(project_id, cache_info, delta_file, deleted_files, engine):
+    """Corpo de /compile-delta; roda com o lock do projeto."""
     project_dir = cache_info['directory']
     
     # Verificar se diretório ainda existe
     if not os.path.exists(project_dir):
-        del project_cache[project_id]
+        forget_project(project_id)
         return jsonify({'error': 'CACHE_MISS', 'message': 'Diretório de cache não existe mais.'}), 410
     
     try:
         # Aplicar deleções
+        deleted = []
         for filepath in deleted_files:
+            if not is_safe_file_name(filepath):
+                continue
             full_path = os.path.join(project_dir, filepath)
+            deleted.append(os.path.normpath(filepath))
             if os.path.exists(full_path):
                 os.remove(full_path)
                 print(f'[Delta] Deletado: {filepath}')
         
         # Aplicar atualizações do delta
-        with zipfile.ZipFile(delta_file, 'r') as z:
-            z.extractall(project_dir)
-        
-        # Recompilar
-        main_file = cache_info.get('main_file') or find_main_file(project_dir)
-        if not main_file:
-            return jsonify({'error': 'Nenhum arquivo .tex encontrado.'}), 400
+        try:
+            written = extract_archive(delta_file, project_dir)
+        except ValueError as e:
+            discard_project_hashes(project_dir)
+            return jsonify({'error': str(e)}), 400
+        record_delta_hashes(project_dir, written, deleted)
         
-        # Atualizar cache
-        project_cache[project_id]['main_file'] = main_file
-        project_cache[project_id]['timestamp'] = os.time()
+        # Arquivo principal do cache, a menos que o delta o tenha removido
+        main_file = cache_info.get('main_file')
+        if not main_file or not os.path.isfile(os.path.join(project_dir, main_file)):
+            main_file = find_main_file(project_dir)
+            if not main_file:
+                return jsonify({'error': 'Nenhum arquivo .tex encontrado.'}), 400
+            register_project(project_id, project_dir, main_file)
         
+        started = time.monotonic()
         result = compile_project(project_dir, main_file, engine, project_id)
+        compile_ms = (time.monotonic() - started) * 1000
         
         if result['success']:
-            with open(result['pdf_path'], 'rb') as f:
-                pdf_data = io.BytesIO(f.read())
-            
-            response = send_file(
-                pdf_data,
-                mimetype='application/pdf',
-                as_attachment=True,
-                download_name='output.pdf'
-            )
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            return response
+            # Diretório do cache é persistente: nada a limpar após o envio
+            return send_pdf_response(result['pdf_path'], compile_ms=compile_ms)
         else:
             return jsonify({
                 'error': 'Compilação falhou.',
-                'log': result['log'][-5000:]
+                'errors': result.get('errors', []),
+                'log': result['log']
             }), 500
             
     except Exception as e:
+        discard_project_hashes(project_dir)
         return jsonify({'error': f'Erro ao aplicar delta: {str(e)}'}), 500
 
 @app.route('/convert/word', methods=['POST'])
@@ -609,29 +1790,29 @@ def convert_word():
     
     pdf_file = request.files['pdf']
     
-    with tempfile.TemporaryDirectory(dir='/tmp', prefix='olc_convert_') as tmp_dir:
+    tmp_dir = tempfile.mkdtemp(dir='/tmp', prefix='olc_convert_')
+    try:
         pdf_path = os.path.join(tmp_dir, 'input.pdf')
         pdf_file.save(pdf_path)
         
         # Converter
         docx_path = convert_pdf_to_word(pdf_path)
-        
-        if docx_path and os.path.isfile(docx_path):
-            with open(docx_path, 'rb') as f:
-                docx_data = io.BytesIO(f.read())
-            
-            response = send_file(
-                docx_data,
-                mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                as_attachment=True,
-                download_name='documento.docx'
-            )
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            return response
-        else:
-            return jsonify({
-                'error': 'Conversão falhou. Verifique se LibreOffice ou pandoc estão instalados.'
-            }), 500
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    
+    if docx_path and os.path.isfile(docx_path):
+        return send_output_file(
+            docx_path,
+            'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+            'documento.docx',
+            cleanup_dir=tmp_dir,
+        )
+    
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    return jsonify({
+        'error': 'Conversão falhou. Verifique se LibreOffice ou pandoc estão instalados.'
+    }), 500
 
 # ═══════════════════════════════════════════════════════════════════
 #  Main
@@ -648,6 +1829,7 @@ if __name__ == '__main__':
     print(f'  Motores:   {", ".join(engines) if engines else "NENHUM!"}')
     print(f'  Timeout:   {COMPILE_TIMEOUT}s')
     print(f'  Max Size:  {MAX_REQUEST_SIZE}MB')
+    print(f'  Cache:     {CACHE_DIR}')
     print(f'  Auth:      {"Ativo" if AUTH_TOKEN else "Desativado"}')
     print(f'  Cloud:     {"GCS" if USE_CLOUD_STORAGE else "Disco local"}')
     print('╚════════════════════════════════════════════════════════════╝')
@@ -655,6 +1837,9 @@ if __name__ == '__main__':
     if not engines:
         print('⚠️  AVISO: Nenhum motor LaTeX encontrado!')
         print('   Certifique-se de que o Dockerfile está usando texlive/texlive:latest-full')
+    else:
+        warmup_latex()
     
-    # Em produção, não use debug=True
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    # Servidor de desenvolvimento (uma thread por requisição, sem limites).
+    # Em produção use: gunicorn -c gunicorn_conf.py latex_server:app
+    app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)